@@ -16,16 +16,17 @@
 import os
 import shutil
 import tempfile
-import urllib2
 from subprocess import check_call
 
+from broot.mirror import MirrorSelector
+
 
 class FedoraBuilder:
     def __init__(self, root, name):
         self._name = name
         self._root = root
 
-    def _setup_yum(self, mirror):
+    def _setup_yum(self, mirrors):
         for repo_name in ["fedora", "fedora-updates",
                           "fedora-updates-testing"]:
             repo_path = os.path.join(self._root.path, "etc", "yum.repos.d",
@@ -34,12 +35,20 @@ class FedoraBuilder:
             with open(repo_path) as f:
                 conf = ""
                 for line in f.readlines():
-                    if mirror is not None:
+                    if mirrors:
                         if line.startswith("#baseurl"):
-                            line = line[1:]
                             base_url = "http://download.fedoraproject.org" \
                                        "/pub/fedora/linux"
-                            line = line.replace(base_url, mirror)
+                            repo_url = line[1:].strip().split("=", 1)[1]
+
+                            # yum tries the urls in order on failure
+                            urls = [repo_url.replace(base_url, mirror)
+                                    for mirror in mirrors]
+                            line = "baseurl=%s\nfailovermethod=priority\n" % \
+                                   "\n        ".join(urls)
+
+                        if line.startswith("failovermethod"):
+                            continue
 
                         if line.startswith("mirrorlist"):
                             line = "#" + line
@@ -71,30 +80,31 @@ class FedoraBuilder:
 
         root_path = self._root.path
 
-        if mirror is None:
-            mirror = "ftp://mirrors.kernel.org/fedora"
-
         if self._name == "fedora-20":
-            release_rpm = "%s/releases/20/Fedora/%s/os/Packages/f/" \
+            release_rpm = "releases/20/Fedora/%s/os/Packages/f/" \
                           "fedora-release-20-1.noarch.rpm" % \
-                          (mirror, self._root.get_arch())
+                          self._root.get_arch()
         else:
-            release_rpm = "%s/releases/19/Fedora/%s/os/Packages/f/" \
+            release_rpm = "releases/19/Fedora/%s/os/Packages/f/" \
                           "fedora-release-19-2.noarch.rpm" % \
-                          (mirror, self._root.get_arch())
+                          self._root.get_arch()
 
-        temp_dir = tempfile.mkdtemp()
+        selector = self._root.get_mirror_selector(mirror, release_rpm)
+        mirrors = selector.get_ranking()
+        if not mirrors:
+            mirrors = ["ftp://mirrors.kernel.org/fedora"]
+            selector = MirrorSelector(mirrors, release_rpm)
 
-        url_f = urllib2.urlopen(release_rpm)
-        rpm_path = os.path.join(temp_dir, "fedora-release.noarch.rpm")
-        with open(rpm_path, "w") as f:
-            f.write(url_f.read())
+        temp_dir = tempfile.mkdtemp()
 
         try:
+            rpm_path = os.path.join(temp_dir, "fedora-release.noarch.rpm")
+            selector.download(release_rpm, rpm_path)
+
             check_call(["rpm", "--root", root_path, "--initdb"])
             check_call(["rpm", "--root", root_path, "-i", rpm_path])
 
-            self._setup_yum(mirror)
+            self._setup_yum(selector.get_best() or mirrors)
 
             check_call(["yum", "-y", "--installroot", root_path, "install",
                         "yum"])
@@ -123,15 +133,44 @@ class DebianBuilder:
     def __init__(self, root):
         self._root = root
 
-    def create(self, mirror=None):
+    def _setup_apt(self, mirrors):
+        sources_path = os.path.join(self._root.path, "etc", "apt",
+                                    "sources.list")
+
+        # apt falls back to the next source when a download fails
+        with open(sources_path, "w") as f:
+            for mirror in mirrors:
+                f.write("deb %s jessie main\n" % mirror)
+
+    def create(self, arch=None, mirror=None):
         root_path = self._root.path
 
-        try:
-            args = ["debootstrap", "jessie", root_path]
-            if mirror is not None:
-                args.append(mirror)
+        selector = self._root.get_mirror_selector(mirror,
+                                                  "dists/jessie/Release")
+        mirrors = selector.get_ranking()
 
-            check_call(args)
+        try:
+            if not mirrors:
+                check_call(["debootstrap", "jessie", root_path])
+                return
+
+            for i, candidate in enumerate(mirrors):
+                try:
+                    check_call(["debootstrap", "jessie", root_path,
+                                candidate])
+                    break
+                except Exception:
+                    if i == len(mirrors) - 1:
+                        raise
+
+                    print "Failed to bootstrap from %s" % candidate
+                    shutil.rmtree(root_path)
+                    os.makedirs(root_path)
+
+            # The mirror which just worked goes first
+            best = [other for other in selector.get_best()
+                    if other != candidate]
+            self._setup_apt([candidate] + best[:2])
         except (Exception, KeyboardInterrupt):
             shutil.rmtree(root_path)
             raise
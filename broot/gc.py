@@ -0,0 +1,325 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import re
+import stat
+from subprocess import check_output
+
+from broot.lock import RootLock
+
+
+def parse_size(size):
+    """Parse a size in bytes, optionally with a K, M, G or T suffix."""
+    if isinstance(size, (int, long, float)):
+        return int(size)
+
+    value = size.strip().upper()
+
+    # Accept 10G, 10GB and 10GiB alike
+    for unit in ["IB", "B"]:
+        if value.endswith(unit):
+            value = value[:-len(unit)]
+            break
+
+    multiplier = 1
+    for i, suffix in enumerate("KMGT"):
+        if value.endswith(suffix):
+            value = value[:-1]
+            multiplier = 1024 ** (i + 1)
+            break
+
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise ValueError("Invalid size %r" % size)
+
+
+class GarbageCollector:
+    """Free space in the broot directory to get its usage under quota.
+
+    Stamps and usage records of roots which no longer exist, and
+    tarballs left behind by interrupted downloads, are always removed.
+    Then roots are evicted, least recently used first, until the usage
+    is under quota. Roots which are locked by another broot process, or
+    which still have something mounted inside them, are never touched.
+    """
+
+    _ROOT_SUFFIXES = [".stamp", ".used", ".lock", ".mounts", ".download"]
+    _LOCK_SUFFIXES = [".lock", ".mounts"]
+    _TARBALL_SUFFIXES = [".tar.xz", ".tmp"]
+
+    # <name>-<hash>, as built by Root._compute_path
+    _ROOT_NAME_RE = re.compile(r"^.+-[A-Za-z0-9]{5}$")
+
+    def __init__(self, var_dir, quota):
+        self._var_dir = var_dir
+        self._quota = quota
+        self._mounted = []
+
+    def _get_mounted(self):
+        mount_points = []
+
+        mount_output = check_output(["mount"]).strip()
+        for mounted in mount_output.split("\n"):
+            mount_points.append(mounted.split(" ")[2])
+
+        return mount_points
+
+    def _ignore_missing(self, function, *args):
+        # Other passes might be removing the same entries
+        try:
+            return function(*args)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        return None
+
+    def _get_size(self, path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            path_stat = self._ignore_missing(os.lstat, path)
+            if path_stat is None:
+                return 0
+
+            return path_stat.st_blocks * 512
+
+        size = 0
+        seen = set()
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            # Don't descend into bind mounts of active roots
+            dir_names[:] = [name for name in dir_names
+                            if os.path.join(dir_path, name)
+                            not in self._mounted]
+
+            for name in [dir_path] + file_names + dir_names:
+                try:
+                    path_stat = os.lstat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+
+                inode = (path_stat.st_dev, path_stat.st_ino)
+                if inode not in seen:
+                    seen.add(inode)
+                    size += path_stat.st_blocks * 512
+
+        return size
+
+    def _get_root_name(self, entry):
+        name = None
+
+        for suffix in self._ROOT_SUFFIXES:
+            if entry.endswith(suffix):
+                name = entry[:-len(suffix)]
+                break
+        else:
+            path = os.path.join(self._var_dir, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                name = entry
+
+        # Leave alone anything we haven't created, like lost+found
+        if name is None or not self._ROOT_NAME_RE.match(name):
+            return None
+
+        return name
+
+    def _is_tarball(self, entry):
+        for suffix in self._TARBALL_SUFFIXES:
+            if entry.endswith(suffix):
+                return True
+
+        return False
+
+    def _is_mounted_in(self, path):
+        for mount_path in self._mounted:
+            if mount_path == path or mount_path.startswith(path + "/"):
+                return True
+
+        return False
+
+    def _get_last_use(self, name):
+        path = os.path.join(self._var_dir, name)
+
+        for used_path in [path + ".used", path + ".stamp", path]:
+            try:
+                return os.stat(used_path).st_mtime
+            except OSError:
+                pass
+
+        return 0
+
+    def _remove_tree(self, path, dev):
+        removed = True
+
+        names = self._ignore_missing(os.listdir, path)
+        if names is None:
+            return True
+
+        for name in names:
+            child_path = os.path.join(path, name)
+
+            child_stat = self._ignore_missing(os.lstat, child_path)
+            if child_stat is None:
+                continue
+
+            if not stat.S_ISDIR(child_stat.st_mode):
+                self._ignore_missing(os.unlink, child_path)
+            elif child_stat.st_dev != dev or \
+                    os.path.ismount(child_path) or \
+                    child_path in self._mounted:
+                print "Not removing mount point %s" % child_path
+                removed = False
+            elif not self._remove_tree(child_path, dev):
+                removed = False
+
+        if removed:
+            self._ignore_missing(os.rmdir, path)
+
+        return removed
+
+    def _remove(self, entry):
+        path = os.path.join(self._var_dir, entry)
+
+        print "Removing %s" % path
+
+        path_stat = self._ignore_missing(os.lstat, path)
+        if path_stat is None:
+            return
+
+        if stat.S_ISDIR(path_stat.st_mode):
+            # Never leave the filesystem, even if something got mounted
+            # after we have checked
+            self._remove_tree(path, path_stat.st_dev)
+        else:
+            self._ignore_missing(os.unlink, path)
+
+    def _lock_root(self, name):
+        root_path = os.path.join(self._var_dir, name)
+
+        # We always need the root lock, we drop it again if nothing is
+        # left. The mounts lock only matters to processes which hold the
+        # root lock, or which have created the mounts lock file already.
+        locks = [RootLock(root_path + ".lock"),
+                 RootLock(root_path + ".mounts", create=False)]
+
+        held_locks = []
+        for lock in locks:
+            try:
+                locked = lock.try_acquire(exclusive=True)
+            except OSError:
+                continue
+
+            if not locked:
+                for held_lock in held_locks:
+                    held_lock.release()
+                return None
+
+            held_locks.append(lock)
+
+        return held_locks
+
+    def collect(self):
+        if not os.path.exists(self._var_dir):
+            return 0
+
+        self._mounted = self._get_mounted()
+
+        entries = os.listdir(self._var_dir)
+
+        sizes = {}
+        for entry in entries:
+            sizes[entry] = self._get_size(os.path.join(self._var_dir, entry))
+
+        usage = sum(sizes.values())
+        freed = 0
+
+        roots = {}
+        for entry in entries:
+            name = self._get_root_name(entry)
+            if name is not None:
+                roots.setdefault(name, []).append(entry)
+            elif self._is_tarball(entry):
+                # Downloads happen in <root>.download, so this is a leftover
+                self._remove(entry)
+                freed += sizes[entry]
+
+        def collect_root(name, evict):
+            root_path = os.path.join(self._var_dir, name)
+
+            locks = self._lock_root(name)
+            if locks is None:
+                return 0
+
+            root_freed = 0
+            try:
+                # Sizing the roots takes a while, things might have been
+                # mounted since we started.
+                self._mounted = self._get_mounted()
+                if self._is_mounted_in(root_path):
+                    return 0
+
+                lock_entries = [name + suffix
+                                for suffix in self._LOCK_SUFFIXES]
+
+                # Another pass might have removed some while we waited
+                roots[name] = [entry for entry in roots[name]
+                               if os.path.lexists(os.path.join(self._var_dir,
+                                                               entry))]
+
+                orphan = not os.path.isdir(root_path)
+                for entry in list(roots[name]):
+                    if entry in lock_entries:
+                        continue
+
+                    if evict or orphan or entry == name + ".download":
+                        self._remove(entry)
+                        roots[name].remove(entry)
+                        root_freed += sizes[entry]
+
+                # Nothing is left to lock, drop the lock files too. We
+                # hold them, so waiting processes will create new ones.
+                if not os.path.exists(root_path) and \
+                        not os.path.exists(root_path + ".stamp") and \
+                        not os.path.exists(root_path + ".download"):
+                    for lock in reversed(locks):
+                        lock.remove()
+
+                    for entry in lock_entries:
+                        if entry in roots[name]:
+                            roots[name].remove(entry)
+                            root_freed += sizes[entry]
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+
+            return root_freed
+
+        for name in roots:
+            freed += collect_root(name, evict=False)
+
+        by_last_use = sorted([name for name in roots
+                              if os.path.isdir(os.path.join(self._var_dir,
+                                                            name))],
+                             key=self._get_last_use)
+
+        for name in by_last_use:
+            if usage - freed <= self._quota:
+                break
+
+            freed += collect_root(name, evict=True)
+
+        return freed
@@ -0,0 +1,178 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fcntl
+import os
+
+
+class RootLock:
+    """A read/write lock shared by every broot process using a root.
+
+    The lock is a flock on a file next to the root. Acquiring it again
+    while it is held only nests, so methods holding the lock can call
+    other locked methods.
+
+    The lock file may be removed by whoever holds the lock exclusively.
+    Processes that were waiting on the removed file notice and lock
+    the new one instead. With create set to False the file is never
+    created, and locking fails with OSError if it doesn't exist.
+
+    If given, message is printed when acquire() has to wait.
+    """
+
+    def __init__(self, path, create=True, message=None):
+        self._path = path
+        self._create = create
+        self._message = message
+        self._fd = None
+        self._depth = 0
+        self._exclusive = False
+
+    @property
+    def held(self):
+        return self._depth > 0
+
+    def _open(self):
+        flags = os.O_RDWR
+
+        if self._create:
+            flags = flags | os.O_CREAT
+
+            try:
+                os.makedirs(os.path.dirname(self._path))
+            except OSError:
+                pass
+
+        fd = os.open(self._path, flags, 0644)
+
+        # Don't let the processes we spawn keep the root locked
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        return fd
+
+    def _nest(self, exclusive):
+        if exclusive and not self._exclusive:
+            raise ValueError("Can't lock %s exclusively while holding it "
+                             "shared" % self._path)
+
+        self._depth += 1
+
+    def _is_current(self, fd):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return False
+
+        fd_stat = os.fstat(fd)
+
+        return (stat.st_dev, stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino)
+
+    def _lock(self, exclusive, blocking):
+        if exclusive:
+            mode = fcntl.LOCK_EX
+        else:
+            mode = fcntl.LOCK_SH
+
+        if not blocking:
+            mode = mode | fcntl.LOCK_NB
+
+        while True:
+            fd = self._open()
+
+            try:
+                fcntl.flock(fd, mode)
+            except IOError, e:
+                os.close(fd)
+                if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            except (Exception, KeyboardInterrupt):
+                os.close(fd)
+                raise
+
+            if self._is_current(fd):
+                break
+
+            # The file was removed while we were waiting for it
+            os.close(fd)
+
+            if not self._create:
+                raise OSError(errno.ENOENT, "Lock file removed", self._path)
+
+        self._fd = fd
+        self._depth = 1
+        self._exclusive = exclusive
+
+        return True
+
+    def try_acquire(self, exclusive):
+        if self.held:
+            self._nest(exclusive)
+            return True
+
+        return self._lock(exclusive, blocking=False)
+
+    def acquire(self, exclusive):
+        """Acquire the lock, returning True if we had to wait for it."""
+        if self.held:
+            self._nest(exclusive)
+            return False
+
+        if self._lock(exclusive, blocking=False):
+            return False
+
+        if self._message is not None:
+            print self._message
+
+        self._lock(exclusive, blocking=True)
+
+        return True
+
+    def _get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def acquire_once(self, marker_path):
+        """Acquire the lock exclusively for work which touches marker_path
+        when it completes.
+
+        Returns True if another process completed the work while we were
+        waiting for the lock, so that it doesn't need to be repeated.
+        """
+        mtime = self._get_mtime(marker_path)
+
+        waited = self.acquire(exclusive=True)
+
+        return waited and self._get_mtime(marker_path) != mtime
+
+    def remove(self):
+        """Remove the lock file, which we must hold exclusively."""
+        if not self.held or not self._exclusive:
+            raise ValueError("Can't remove %s without holding it "
+                             "exclusively" % self._path)
+
+        os.unlink(self._path)
+
+    def release(self):
+        self._depth -= 1
+
+        if self._depth == 0:
+            os.close(self._fd)
+            self._fd = None
+            self._exclusive = False
@@ -17,6 +17,7 @@ import argparse
 import os
 import sys
 
+from broot.gc import GarbageCollector, parse_size
 from broot.root import Root
 
 
@@ -52,6 +53,30 @@ def cmd_distribute(options, other_args):
     return root.distribute()
 
 
+def cmd_gc(options, other_args):
+    try:
+        if options.quota is not None:
+            source = "--quota"
+            quota = parse_size(options.quota)
+        elif os.path.exists("root.json"):
+            source = "gc_quota in root.json"
+            quota = Root().get_gc_quota()
+        else:
+            quota = None
+    except ValueError, e:
+        print("%s: %s" % (source, e))
+        return False
+
+    if quota is None:
+        print("You must specify a quota with --quota or gc_quota in "
+              "root.json.")
+        return False
+
+    GarbageCollector(Root.VAR_DIR, quota).collect()
+
+    return True
+
+
 def main():
     if not os.geteuid() == 0:
         sys.exit("You must run the command as root")
@@ -74,6 +99,9 @@ def main():
     subparsers.add_parser("distribute")
     subparsers.add_parser("clean")
 
+    gc_parser = subparsers.add_parser("gc")
+    gc_parser.add_argument("--quota")
+
     options, other_args = parser.parse_known_args()
 
     cmd_function = globals()["cmd_%s" % options.command]
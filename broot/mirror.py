@@ -0,0 +1,224 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib2
+
+
+class MirrorSelector:
+    """Rank a list of candidate mirrors by probing them concurrently.
+
+    Each candidate is probed by fetching up to probe_bytes of probe_path
+    from it. Mirrors are ordered by the time that took, so both latency
+    and throughput count. Unreachable mirrors are kept at the end of the
+    ranking as a last resort. The ranking is cached in cache_path for
+    ttl seconds.
+    """
+
+    def __init__(self, candidates, probe_path, cache_path=None, ttl=3600,
+                 timeout=10, probe_bytes=64 * 1024):
+        self._candidates = [mirror.rstrip("/") for mirror in candidates]
+        self._probe_path = probe_path.lstrip("/")
+        self._cache_path = cache_path
+        self._ttl = ttl
+        self._timeout = timeout
+        self._probe_bytes = probe_bytes
+        self._ranking = None
+        self._reachable = None
+
+    def _get_url(self, mirror, path):
+        return "%s/%s" % (mirror, path.lstrip("/"))
+
+    def _get_cache_key(self):
+        key_hash = hashlib.sha1()
+        key_hash.update(self._probe_path)
+        for mirror in sorted(self._candidates):
+            key_hash.update("\n" + mirror)
+
+        return key_hash.hexdigest()
+
+    def _load_cache(self):
+        if self._cache_path is None:
+            return {}
+
+        try:
+            with open(self._cache_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _read_cached_ranking(self):
+        entry = self._load_cache().get(self._get_cache_key())
+        if entry is None or "reachable" not in entry:
+            return None
+
+        if time.time() - entry["time"] > self._ttl:
+            return None
+
+        if sorted(entry["ranking"]) != sorted(self._candidates):
+            return None
+
+        return entry["ranking"], entry["reachable"]
+
+    def _write_cached_ranking(self, ranking, reachable):
+        if self._cache_path is None:
+            return
+
+        cache = self._load_cache()
+
+        now = time.time()
+        for key in cache.keys():
+            if now - cache[key]["time"] > self._ttl:
+                del cache[key]
+
+        cache[self._get_cache_key()] = {"time": now,
+                                        "ranking": ranking,
+                                        "reachable": reachable}
+
+        try:
+            with open(self._cache_path, "w") as f:
+                json.dump(cache, f)
+        except IOError:
+            pass
+
+    def _probe(self, mirror):
+        url = self._get_url(mirror, self._probe_path)
+
+        start = time.time()
+        try:
+            url_f = urllib2.urlopen(url, timeout=self._timeout)
+            try:
+                url_f.read(self._probe_bytes)
+            finally:
+                url_f.close()
+        except Exception:
+            return None
+
+        return time.time() - start
+
+    def probe(self):
+        results = {}
+
+        def probe_one(mirror):
+            results[mirror] = self._probe(mirror)
+
+        threads = []
+        for mirror in self._candidates:
+            thread = threading.Thread(target=probe_one, args=(mirror,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join(self._timeout * 2)
+
+        return results
+
+    def _compute_ranking(self):
+        results = self.probe()
+
+        reachable = [mirror for mirror in self._candidates
+                     if results.get(mirror) is not None]
+        reachable.sort(key=lambda mirror: results[mirror])
+
+        unreachable = [mirror for mirror in self._candidates
+                       if mirror not in reachable]
+
+        return reachable + unreachable, reachable
+
+    def _rank(self):
+        if self._ranking is not None:
+            return
+
+        if len(self._candidates) < 2:
+            self._ranking = list(self._candidates)
+            self._reachable = list(self._candidates)
+            return
+
+        cached = self._read_cached_ranking()
+        if cached is None:
+            cached = self._compute_ranking()
+            self._write_cached_ranking(*cached)
+
+        self._ranking, self._reachable = cached
+
+    def get_ranking(self):
+        """All the candidates, fastest first, unreachable ones last."""
+        self._rank()
+
+        return self._ranking
+
+    def get_best(self, count=3):
+        """The fastest count mirrors which answered the probe."""
+        self._rank()
+
+        return self._reachable[:count]
+
+    def _download_from(self, url, f):
+        offset = f.tell()
+
+        request = urllib2.Request(url)
+        if offset > 0 and url.startswith("http"):
+            request.add_header("Range", "bytes=%d-" % offset)
+
+        url_f = urllib2.urlopen(request, timeout=self._timeout)
+        try:
+            if offset > 0 and url_f.getcode() != 206:
+                # The mirror can't resume, start over
+                f.seek(0)
+                f.truncate()
+
+            length = url_f.info().getheader("Content-Length")
+            start = f.tell()
+
+            while True:
+                data = url_f.read(64 * 1024)
+                if not data:
+                    break
+                f.write(data)
+
+            if length is not None and f.tell() - start < int(length):
+                raise IOError("Transfer interrupted after %d bytes" %
+                              (f.tell() - start))
+        finally:
+            url_f.close()
+
+    def download(self, path, dest_path):
+        """Download path from the fastest mirror into dest_path.
+
+        If a mirror fails, even halfway through the transfer, the next
+        one in the ranking is tried, resuming where the previous left off
+        when the server supports it.
+        """
+        last_error = None
+
+        with open(dest_path, "wb") as f:
+            for mirror in self.get_ranking():
+                url = self._get_url(mirror, path)
+                try:
+                    self._download_from(url, f)
+                    return
+                except Exception, e:
+                    print "Failed to download %s: %s" % (url, e)
+                    last_error = e
+
+        if last_error is None:
+            raise ValueError("No mirrors available to download %s" % path)
+
+        raise last_error
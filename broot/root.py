@@ -27,6 +27,9 @@ import wget
 
 from broot.builder import FedoraBuilder
 from broot.builder import DebianBuilder
+from broot.gc import GarbageCollector, parse_size
+from broot.lock import RootLock
+from broot.mirror import MirrorSelector
 
 
 class Root:
@@ -34,9 +37,11 @@ class Root:
     STATE_READY = "ready"
     STATE_INVALID = "invalid"
 
+    VAR_DIR = os.path.join("/var", "lib", "broot")
+
     def __init__(self):
         self._config_path = os.path.abspath("root.json")
-        self._var_dir = os.path.join("/var", "lib", "broot")
+        self._var_dir = self.VAR_DIR
         self._use_run_shm = os.path.exists("/run/shm")
         self._hash_len = 5
 
@@ -44,6 +49,10 @@ class Root:
             self._config = json.load(f)
 
         self.path = self._compute_path()
+        self._lock = RootLock(self.path + ".lock",
+                              message="Waiting for another broot process "
+                                      "to release the root...")
+        self._mounts_lock = RootLock(self.path + ".mounts")
 
         self._mounts = self._compute_mounts()
         self._user_name = "broot"
@@ -71,6 +80,41 @@ class Root:
                             (self._config["name"],
                              base64_hash[0:self._hash_len]))
 
+    def _get_mirror_candidates(self):
+        mirrors = list(self._config.get("mirrors", []))
+
+        mirror_list = self._config.get("mirror_list")
+        if mirror_list:
+            try:
+                lines = urllib2.urlopen(mirror_list,
+                                        timeout=10).read().split("\n")
+            except Exception, e:
+                print "Failed to download %s: %s" % (mirror_list, e)
+                lines = []
+
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith("#") and line not in mirrors:
+                    mirrors.append(line)
+
+        return mirrors
+
+    def get_mirror_selector(self, mirror, probe_path):
+        if mirror is not None:
+            candidates = [mirror]
+        else:
+            candidates = self._get_mirror_candidates()
+
+        try:
+            os.makedirs(self._var_dir)
+        except OSError:
+            pass
+
+        return MirrorSelector(candidates, probe_path,
+                              cache_path=os.path.join(self._var_dir,
+                                                      "mirrors.json"),
+                              ttl=self._config.get("mirrors_ttl", 3600))
+
     def _get_user_mounts(self):
         return self._config.get("user_mounts", {})
 
@@ -114,14 +158,21 @@ class Root:
         if not self._check_exists(True):
             return False
 
-        mounted = self._get_mounted()
+        # Concurrent runs would otherwise stack their bind mounts
+        self._mounts_lock.acquire(exclusive=True)
+        try:
+            mounted = self._get_mounted()
 
-        for source_path, dest_path in self._mounts.items():
-            if dest_path not in mounted:
-                if os.path.exists(dest_path):
-                    check_call(["mount", "--bind", source_path, dest_path])
+            for source_path, dest_path in self._mounts.items():
+                if dest_path not in mounted:
+                    if os.path.exists(dest_path):
+                        check_call(["mount", "--bind", source_path,
+                                    dest_path])
+        finally:
+            self._mounts_lock.release()
 
         self._setup_dns()
+        self._touch_used()
 
     def setup_xauth(self):
         source_path = os.environ["XAUTHORITY"]
@@ -154,12 +205,15 @@ class Root:
                         print "Failed: %s" % e
 
     def deactivate(self):
-        self._kill_processes()
+        self._mounts_lock.acquire(exclusive=True)
+        try:
+            self._kill_processes()
 
-        mounted = self._get_mounted()
-        for mount_path in reversed(self._mounts.values()):
-            if mount_path in mounted:
-                check_call(["umount", mount_path])
+            for mount_path in reversed(self._mounts.values()):
+                while mount_path in self._get_mounted():
+                    check_call(["umount", mount_path])
+        finally:
+            self._mounts_lock.release()
 
     def _install_npm_packages(self):
         npm_packages = self._config.get("npm_packages")
@@ -193,6 +247,26 @@ class Root:
     def _get_stamp_path(self):
         return self.path + ".stamp"
 
+    def _touch_used(self):
+        used_path = self.path + ".used"
+
+        with open(used_path, "a"):
+            pass
+
+        os.utime(used_path, None)
+
+    def get_gc_quota(self):
+        quota = self._config.get("gc_quota")
+        if quota is None:
+            return None
+
+        return parse_size(quota)
+
+    def _collect_garbage(self):
+        quota = self.get_gc_quota()
+        if quota is not None:
+            GarbageCollector(self._var_dir, quota).collect()
+
     def _check_exists(self, exists, message=True):
         if exists:
             if not os.path.exists(self.path):
@@ -207,10 +281,27 @@ class Root:
 
         return True
 
+    def _check_ready(self):
+        return self._check_exists(True, message=False) and \
+            self._check_stamp()
+
     def create(self, arch=None, mirror=None):
+        done = self._lock.acquire_once(self._get_stamp_path())
+        try:
+            # Another process has just created it for us
+            if done and self._check_ready():
+                return True
+
+            return self._create(arch, mirror)
+        finally:
+            self._lock.release()
+
+    def _create(self, arch, mirror):
         if not self._check_exists(False):
             return False
 
+        self._collect_garbage()
+
         try:
             os.makedirs(self.path)
         except OSError:
@@ -233,6 +324,17 @@ class Root:
         return True
 
     def setup(self):
+        done = self._lock.acquire_once(self._get_stamp_path())
+        try:
+            # Another process has just set it up for us
+            if done and self._check_ready():
+                return True
+
+            return self._setup()
+        finally:
+            self._lock.release()
+
+    def _setup(self):
         broot_exists = self._check_exists(True, message=False)
         broot_valid = self._check_stamp()
 
@@ -246,9 +348,23 @@ class Root:
         finally:
             self.deactivate()
 
+        # Let the processes waiting for us know that setup is done
+        self._touch_stamp()
+
         return True
 
     def clean(self):
+        waited = self._lock.acquire(exclusive=True)
+        try:
+            # Another process has just cleaned it for us
+            if waited and not self._check_exists(True, message=False):
+                return True
+
+            return self._clean()
+        finally:
+            self._lock.release()
+
+    def _clean(self):
         if not self._check_exists(True):
             return False
 
@@ -283,17 +399,27 @@ class Root:
             print "Failed to download %s" % last_url
             raise
 
+        self._collect_garbage()
+
+        # Download in a directory of our own, so that garbage collection
+        # can tell an interrupted download from one in progress.
+        download_dir = self.path + ".download"
+
         try:
-            os.makedirs(self._var_dir)
+            os.makedirs(download_dir)
         except OSError:
             pass
 
-        os.chdir(self._var_dir)
+        os.chdir(download_dir)
 
         tar_filename = wget.download(prebuilt_url + last)
         if tar_filename is None:
             return False
 
+        tar_filename = os.path.join(download_dir, tar_filename)
+
+        os.chdir(self._var_dir)
+
         from_path = "%s-.{%d}" % (self.path[1:self.path.rindex("-")],
                                   self._hash_len)
         to_path = os.path.basename(self.path)
@@ -302,7 +428,7 @@ class Root:
                       "--transform 's,^%s,%s,x' -xf %s" %
                       (from_path, to_path, tar_filename), shell=True)
 
-        os.unlink(tar_filename)
+        shutil.rmtree(download_dir, ignore_errors=True)
 
         print ""
 
@@ -314,61 +440,91 @@ class Root:
         return True
 
     def distribute(self):
-        if not self._check_exists(True):
-            return False
+        self._lock.acquire(exclusive=True)
+        try:
+            if not self._check_exists(True):
+                return False
 
-        name = self._config["name"]
+            name = self._config["name"]
 
-        check_call(["tar", "cvfJ", "%s-broot.tar.xz" % name, self.path])
+            check_call(["tar", "cvfJ", "%s-broot.tar.xz" % name, self.path])
 
-        return True
+            return True
+        finally:
+            self._lock.release()
 
     def run(self, command, as_root=False):
-        if not self._check_exists(True):
-            return False
+        # Nested in create or setup, which already hold the lock
+        if self._lock.held:
+            if not self._check_exists(True):
+                return False
+
+            self.activate()
+            try:
+                return self._run_activated(command, as_root)
+            finally:
+                self.deactivate()
+
+        self._lock.acquire(exclusive=False)
+        try:
+            if not self._check_exists(True):
+                return False
+
+            self.activate()
+            return self._run_activated(command, as_root)
+        finally:
+            # Other runs might still be using the mounts, leave them to the
+            # last one out. Holding the mounts lock, nobody can activate or
+            # deactivate between our release and the check.
+            self._mounts_lock.acquire(exclusive=True)
+            try:
+                self._lock.release()
+
+                if self._lock.try_acquire(exclusive=True):
+                    try:
+                        self.deactivate()
+                    finally:
+                        self._lock.release()
+            finally:
+                self._mounts_lock.release()
 
+    def _run_activated(self, command, as_root):
         if as_root:
             chroot_command = "chroot"
         else:
             chroot_command = "chroot --userspec %d:%d" % (self._uid, self._gid)
 
-        self.activate()
-        try:
-            if not as_root:
-                self.setup_xauth()
+        if not as_root:
+            self.setup_xauth()
 
-            env = {"LANG": "C",
-                   "PATH": "/bin:/usr/bin:/usr/sbin"}
-            to_keep = ["http_proxy", "https_proxy"]
+        env = {"LANG": "C",
+               "PATH": "/bin:/usr/bin:/usr/sbin"}
+        to_keep = ["http_proxy", "https_proxy"]
 
-            if as_root:
-                env["HOME"] = "/root"
-            else:
-                home_dir = "/home/%s" % self._user_name
-
-                env["HOME"] = home_dir
-                env["XAUTHORITY"] = os.path.join(home_dir, ".Xauthority")
-                env["BROOT"] = "yes"
+        if as_root:
+            env["HOME"] = "/root"
+        else:
+            home_dir = "/home/%s" % self._user_name
 
-                to_keep.extend(["DISPLAY", "XAUTHLOCALHOSTNAME", "TERM"])
+            env["HOME"] = home_dir
+            env["XAUTHORITY"] = os.path.join(home_dir, ".Xauthority")
+            env["BROOT"] = "yes"
 
-            for name in to_keep:
-                if name in os.environ:
-                    env[name] = os.environ[name]
+            to_keep.extend(["DISPLAY", "XAUTHLOCALHOSTNAME", "TERM"])
 
-            env_string = ""
-            for name, value in env.items():
-                env_string += "%s=%s " % (name, value)
+        for name in to_keep:
+            if name in os.environ:
+                env[name] = os.environ[name]
 
-            result = call("%s %s /usr/bin/env -i %s /bin/bash -lc \"%s\"" %
-                          (chroot_command, self.path, env_string, command),
-                          shell=True)
+        env_string = ""
+        for name, value in env.items():
+            env_string += "%s=%s " % (name, value)
 
-            return result == 0
-        finally:
-            self.deactivate()
+        result = call("%s %s /usr/bin/env -i %s /bin/bash -lc \"%s\"" %
+                      (chroot_command, self.path, env_string, command),
+                      shell=True)
 
-        return True
+        return result == 0
 
     def _check_stamp(self):
         try:
@@ -46,5 +46,6 @@ setup(name="broot",
       url="http://github.com/dnarvaez/broot",
       classifiers=classifiers,
       cmdclass={"lint": LintCommand},
+      test_suite="tests",
       install_requires=["wget==2.0"],
       scripts=["scripts/broot"])
@@ -0,0 +1,168 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from broot.gc import GarbageCollector, parse_size
+from broot.lock import RootLock
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_size(1000), 1000)
+        self.assertEqual(parse_size("1000"), 1000)
+        self.assertEqual(parse_size("2K"), 2048)
+        self.assertEqual(parse_size("1.5m"), 1536 * 1024)
+        self.assertEqual(parse_size("10GB"), 10 * 1024 ** 3)
+        self.assertEqual(parse_size("10GiB"), 10 * 1024 ** 3)
+        self.assertEqual(parse_size("512B"), 512)
+        self.assertEqual(parse_size(1e10), 10000000000)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_size, "10XB")
+        self.assertRaises(ValueError, parse_size, "")
+
+
+class RacingGarbageCollector(GarbageCollector):
+    """Removes entries behind our back, like a concurrent pass would."""
+
+    def __init__(self, var_dir, quota, to_remove):
+        GarbageCollector.__init__(self, var_dir, quota)
+        self._to_remove = to_remove
+
+    def _get_mounted(self):
+        for path in self._to_remove:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.unlink(path)
+
+        return GarbageCollector._get_mounted(self)
+
+
+class TestGarbageCollector(unittest.TestCase):
+    def setUp(self):
+        self._var_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._var_dir)
+
+    def _path(self, name):
+        return os.path.join(self._var_dir, name)
+
+    def _create_root(self, name, last_use, size=1024 * 1024):
+        os.makedirs(self._path(os.path.join(name, "etc")))
+
+        with open(self._path(os.path.join(name, "etc", "data")), "w") as f:
+            f.write("x" * size)
+
+        with open(self._path(name + ".stamp"), "w") as f:
+            f.write("stamp")
+
+        lock = RootLock(self._path(name + ".lock"))
+        lock.acquire(exclusive=False)
+        lock.release()
+
+        open(self._path(name + ".used"), "w").close()
+        os.utime(self._path(name + ".used"), (last_use, last_use))
+
+    def _collect(self, quota):
+        return GarbageCollector(self._var_dir, quota).collect()
+
+    def test_garbage(self):
+        self._create_root("kept-AAAAA", 100)
+
+        with open(self._path("orphan-BBBBB.stamp"), "w") as f:
+            f.write("stamp")
+
+        with open(self._path("prebuilt.tar.xz"), "w") as f:
+            f.write("x" * 1024)
+
+        os.makedirs(self._path("kept-AAAAA.download"))
+        with open(self._path("mirrors.json"), "w") as f:
+            f.write("{}")
+
+        self.assertTrue(self._collect(parse_size("1G")) > 0)
+
+        self.assertEqual(sorted(os.listdir(self._var_dir)),
+                         ["kept-AAAAA", "kept-AAAAA.lock", "kept-AAAAA.stamp",
+                          "kept-AAAAA.used", "mirrors.json"])
+
+    def test_evict_least_recently_used(self):
+        self._create_root("old-AAAAA", 100)
+        self._create_root("new-BBBBB", 300)
+        self._create_root("mid-CCCCC", 200)
+
+        self._collect(parse_size("1.5M"))
+
+        self.assertEqual(sorted(os.listdir(self._var_dir)),
+                         ["new-BBBBB", "new-BBBBB.lock", "new-BBBBB.stamp",
+                          "new-BBBBB.used"])
+
+    def test_skip_locked(self):
+        self._create_root("old-AAAAA", 100)
+        self._create_root("new-BBBBB", 200)
+
+        lock = RootLock(self._path("old-AAAAA.lock"))
+        lock.acquire(exclusive=False)
+        try:
+            self._collect(parse_size("1.5M"))
+        finally:
+            lock.release()
+
+        self.assertTrue(os.path.exists(self._path("old-AAAAA")))
+        self.assertFalse(os.path.exists(self._path("new-BBBBB")))
+
+    def test_no_lock_files_left(self):
+        self._create_root("old-AAAAA", 100)
+
+        with open(self._path("orphan-BBBBB.stamp"), "w") as f:
+            f.write("stamp")
+
+        self._collect(0)
+        self._collect(0)
+
+        self.assertEqual(os.listdir(self._var_dir), [])
+
+    def test_foreign_entries(self):
+        self._create_root("old-AAAAA", 100)
+
+        os.makedirs(self._path("lost+found"))
+        os.utime(self._path("lost+found"), (0, 0))
+
+        self._collect(0)
+
+        self.assertEqual(os.listdir(self._var_dir), ["lost+found"])
+
+    def test_concurrent_removal(self):
+        self._create_root("old-AAAAA", 100)
+
+        with open(self._path("orphan-BBBBB.stamp"), "w") as f:
+            f.write("stamp")
+
+        to_remove = [self._path("orphan-BBBBB.stamp"),
+                     self._path("old-AAAAA.used"),
+                     self._path(os.path.join("old-AAAAA", "etc"))]
+
+        RacingGarbageCollector(self._var_dir, 0, to_remove).collect()
+
+        self.assertEqual(os.listdir(self._var_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
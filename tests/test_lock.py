@@ -0,0 +1,158 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from broot.lock import RootLock
+
+
+def hold_lock(path, exclusive, locked, marker_path=None, remove=False):
+    lock = RootLock(path)
+    lock.acquire(exclusive)
+    locked.set()
+
+    time.sleep(0.5)
+
+    if marker_path is not None:
+        with open(marker_path, "w") as f:
+            f.write("done")
+
+    if remove:
+        lock.remove()
+
+    lock.release()
+
+
+class TestRootLock(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._temp_dir, "root.lock")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _start_holder(self, exclusive=True, **kwargs):
+        locked = multiprocessing.Event()
+
+        process = multiprocessing.Process(target=hold_lock,
+                                          args=(self._path, exclusive,
+                                                locked),
+                                          kwargs=kwargs)
+        process.start()
+
+        self.assertTrue(locked.wait(10))
+
+        return process
+
+    def test_shared(self):
+        first = RootLock(self._path)
+        second = RootLock(self._path)
+
+        self.assertTrue(first.try_acquire(exclusive=False))
+        self.assertTrue(second.try_acquire(exclusive=False))
+        self.assertFalse(RootLock(self._path).try_acquire(exclusive=True))
+
+        first.release()
+        second.release()
+
+        self.assertTrue(RootLock(self._path).try_acquire(exclusive=True))
+
+    def test_exclusive(self):
+        lock = RootLock(self._path)
+        self.assertFalse(lock.acquire(exclusive=True))
+
+        self.assertFalse(RootLock(self._path).try_acquire(exclusive=False))
+
+        lock.release()
+        self.assertFalse(lock.held)
+
+    def test_nested(self):
+        lock = RootLock(self._path)
+        lock.acquire(exclusive=True)
+        lock.acquire(exclusive=False)
+        lock.release()
+
+        self.assertTrue(lock.held)
+        self.assertFalse(RootLock(self._path).try_acquire(exclusive=False))
+
+        lock.release()
+        self.assertFalse(lock.held)
+
+    def test_nested_upgrade(self):
+        lock = RootLock(self._path)
+        lock.acquire(exclusive=False)
+
+        self.assertRaises(ValueError, lock.acquire, exclusive=True)
+        self.assertRaises(ValueError, lock.try_acquire, exclusive=True)
+
+        lock.release()
+        self.assertFalse(lock.held)
+
+    def test_wait(self):
+        process = self._start_holder()
+
+        lock = RootLock(self._path)
+        start = time.time()
+        self.assertTrue(lock.acquire(exclusive=False))
+        self.assertTrue(time.time() - start > 0.2)
+        lock.release()
+
+        process.join()
+
+    def test_acquire_once_done(self):
+        marker_path = os.path.join(self._temp_dir, "root.stamp")
+        process = self._start_holder(marker_path=marker_path)
+
+        lock = RootLock(self._path)
+        self.assertTrue(lock.acquire_once(marker_path))
+        lock.release()
+
+        process.join()
+
+    def test_acquire_once_not_done(self):
+        marker_path = os.path.join(self._temp_dir, "root.stamp")
+        with open(marker_path, "w") as f:
+            f.write("done")
+
+        # A reader, like run, doesn't do the work for us
+        process = self._start_holder(exclusive=False)
+
+        lock = RootLock(self._path)
+        self.assertFalse(lock.acquire_once(marker_path))
+        lock.release()
+
+        process.join()
+
+    def test_removed_while_waiting(self):
+        process = self._start_holder(remove=True)
+
+        lock = RootLock(self._path)
+        self.assertTrue(lock.acquire(exclusive=True))
+
+        self.assertTrue(os.path.exists(self._path))
+        self.assertFalse(RootLock(self._path).try_acquire(exclusive=False))
+
+        lock.release()
+
+        process.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
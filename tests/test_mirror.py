@@ -0,0 +1,175 @@
+# Copyright 2013 Daniel Narvaez
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from broot.mirror import MirrorSelector
+
+DATA = "".join(chr(i % 256) for i in range(256 * 1024))
+
+
+class QuietHTTPServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        # Probes close the connection after reading what they need
+        pass
+
+
+class MirrorServer:
+    def __init__(self, delay=0, truncate=None, ranges=True):
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                range_header = self.headers.get("Range")
+                server.requests.append((self.path, range_header))
+
+                time.sleep(delay)
+
+                start = 0
+                if range_header is not None and ranges:
+                    start = int(range_header[len("bytes="):-1])
+                    self.send_response(206)
+                else:
+                    self.send_response(200)
+
+                self.send_header("Content-Length", str(len(DATA) - start))
+                self.end_headers()
+
+                body = DATA[start:]
+                if truncate is not None:
+                    body = body[:truncate]
+
+                self.wfile.write(body)
+
+        self._httpd = QuietHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d/mirror" % self._httpd.server_port
+
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class TestMirrorSelector(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._cache_path = os.path.join(self._temp_dir, "mirrors.json")
+        self._servers = []
+
+    def tearDown(self):
+        for server in self._servers:
+            server.stop()
+
+        shutil.rmtree(self._temp_dir)
+
+    def _start_server(self, *args, **kwargs):
+        server = MirrorServer(*args, **kwargs)
+        self._servers.append(server)
+        return server
+
+    def _create_selector(self, servers, ttl=3600):
+        candidates = [server.url for server in servers]
+        candidates.append("http://127.0.0.1:1/unreachable")
+
+        return MirrorSelector(candidates, "file", cache_path=self._cache_path,
+                              ttl=ttl, timeout=5)
+
+    def test_ranking(self):
+        slow = self._start_server(delay=0.6)
+        fast = self._start_server()
+        medium = self._start_server(delay=0.3)
+
+        selector = self._create_selector([slow, fast, medium])
+
+        self.assertEqual(selector.get_ranking(),
+                         [fast.url, medium.url, slow.url,
+                          "http://127.0.0.1:1/unreachable"])
+        self.assertEqual(selector.get_best(2), [fast.url, medium.url])
+
+    def test_cache(self):
+        slow = self._start_server(delay=0.3)
+        fast = self._start_server()
+
+        ranking = self._create_selector([slow, fast]).get_ranking()
+        self.assertEqual(len(fast.requests), 1)
+
+        self.assertEqual(self._create_selector([slow, fast]).get_ranking(),
+                         ranking)
+        self.assertEqual(len(fast.requests), 1)
+
+    def test_cache_expiry(self):
+        slow = self._start_server(delay=0.3)
+        fast = self._start_server()
+
+        self._create_selector([slow, fast], ttl=60).get_ranking()
+
+        with open(self._cache_path) as f:
+            cache = json.load(f)
+
+        for entry in cache.values():
+            entry["time"] -= 120
+
+        with open(self._cache_path, "w") as f:
+            json.dump(cache, f)
+
+        self._create_selector([slow, fast], ttl=60).get_ranking()
+        self.assertEqual(len(fast.requests), 2)
+
+    def test_failover_resume(self):
+        broken = self._start_server(truncate=50000)
+        working = self._start_server(delay=0.3)
+
+        selector = self._create_selector([broken, working])
+        self.assertEqual(selector.get_ranking()[0], broken.url)
+
+        dest_path = os.path.join(self._temp_dir, "file")
+        selector.download("file", dest_path)
+
+        with open(dest_path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+
+        self.assertEqual(working.requests[-1], ("/mirror/file",
+                                                "bytes=50000-"))
+
+    def test_failover_restart(self):
+        broken = self._start_server(truncate=50000)
+        working = self._start_server(delay=0.3, ranges=False)
+
+        selector = self._create_selector([broken, working])
+
+        dest_path = os.path.join(self._temp_dir, "file")
+        selector.download("file", dest_path)
+
+        with open(dest_path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+
+
+if __name__ == "__main__":
+    unittest.main()